@@ -1,13 +1,20 @@
 import streamlit as st
 import os
 import pandas as pd
-from supabase import create_client, Client
+from supabase import create_client, Client, PostgrestAPIError, StorageException
+import httpx
 from dotenv import load_dotenv
-from collections import defaultdict
-from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import contextlib
+import hashlib
 import io
-from pypdf import PdfWriter, PdfReader
+import math
+import tempfile
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+import pikepdf
 
 # --- Configuração do App e Conexão com Supabase ---
 st.set_page_config(page_title="Painel de Comprovantes", layout="wide")
@@ -30,148 +37,328 @@ def init_supabase_client():
 supabase = init_supabase_client()
 
 # --- Busca e Processamento dos Dados ---
-@st.cache_data(ttl=600)
-def fetch_data_from_supabase(_db_client: Client):
-    """Busca todos os comprovantes do banco de dados, paginando os resultados."""
+# Os caches abaixo usam cache_resource: os objetos retornados são compartilhados entre
+# reruns e sessões sem serem copiados, por isso nunca devem ser modificados.
+# Falhas de busca levantam SupabaseFetchError em vez de retornar dados parciais: exceções
+# não são cacheadas, então um erro transitório não fica preso no cache para todas as sessões.
+RECEIPT_COLUMNS = "id, nome_recebedor, cnpj_recebedor, chave_pix, data_transferencia, valor, pdf_url"
+
+class SupabaseFetchError(Exception):
+    """Indica que a busca dos comprovantes no Supabase falhou."""
+
+def _fetch_all_pages(build_query):
+    """Executa a consulta montada por `build_query`, paginando os resultados pelo `id` (keyset)."""
     all_data = []
-    offset = 0
+    last_id = None
     page_size = 1000  # Corresponde ao limite padrão do Supabase
 
     while True:
         try:
-            response = _db_client.table('comprovantes').select(
-                "nome_recebedor, cnpj_recebedor, chave_pix, data_transferencia, valor, pdf_url"
-            ).range(offset, offset + page_size - 1).execute()
-
-            if not response.data:
-                break  # Sai do loop se não houver mais dados
+            query = build_query().order('id')
+            if last_id is not None:
+                # Continua a partir do último id lido, sem OFFSET re-escaneando linhas já vistas
+                query = query.gt('id', last_id)
+            response = query.limit(page_size).execute()
 
             all_data.extend(response.data)
-            offset += page_size
+
+            if len(response.data) < page_size:
+                break  # Última página: não há mais dados
+
+            last_id = response.data[-1]['id']
 
         except Exception as e:
-            st.error(f"Erro ao buscar dados do Supabase: {e}")
-            return all_data
+            raise SupabaseFetchError(f"Erro ao buscar dados do Supabase: {e}") from e
             
-    return all_data
+    return tuple(MappingProxyType(r) for r in all_data)
+
+@st.cache_resource(ttl=600)
+def fetch_data_from_supabase(_db_client: Client):
+    """Busca todos os comprovantes do banco de dados, paginando os resultados."""
+    return _fetch_all_pages(lambda: _db_client.table('comprovantes').select(RECEIPT_COLUMNS))
+
+def _ilike_pattern(term: str) -> str:
+    """Monta o padrão `%termo%` do ilike, escapando curingas e caracteres reservados do PostgREST."""
+    # Escapa os curingas do LIKE para que '%' e '_' digitados sejam literais
+    like = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    # Aspas duplas protegem vírgulas e parênteses dentro do filtro `or`
+    quoted = f"%{like}%".replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{quoted}"'
+
+@st.cache_resource(ttl=600, max_entries=128)
+def fetch_matching(_db_client: Client, term: str):
+    """Busca apenas os comprovantes que casam com o termo, filtrando no próprio Postgres."""
+    pattern = _ilike_pattern(term)
+    filters = f"nome_recebedor.ilike.{pattern},cnpj_recebedor.ilike.{pattern},chave_pix.ilike.{pattern}"
+    return _fetch_all_pages(lambda: _db_client.table('comprovantes').select(RECEIPT_COLUMNS).or_(filters))
+
+_BRL_SEPARATORS = str.maketrans({",": ".", ".": ","})
+
+def format_brl(value: float) -> str:
+    """Formata um valor no padrão monetário brasileiro (ex.: R$ 1.234,56)."""
+    return f"R$ {value:,.2f}".translate(_BRL_SEPARATORS)
+
+@st.cache_resource(ttl="10m", max_entries=256)
+def build_df(_db_client: Client, term: str = ""):
+    """Monta o DataFrame dos comprovantes do termo, com datas convertidas e do mais recente ao mais antigo."""
+    receipts = fetch_matching(_db_client, term) if term else fetch_data_from_supabase(_db_client)
+    df = pd.DataFrame(receipts, columns=[c.strip() for c in RECEIPT_COLUMNS.split(",")])
+    df['data_dt'] = pd.to_datetime(df['data_transferencia'], format='%Y-%m-%d')
+    df['data_fmt'] = df['data_dt'].dt.strftime('%d/%m/%Y')
+    df['valor'] = df['valor'].fillna(0.0)
+    df['valor_fmt'] = df['valor'].map(format_brl)
+    # Colunas de texto em pyarrow: operações de string vetorizadas em C e menos memória
+    df = df.astype({
+        'nome_recebedor': 'string[pyarrow]',
+        'cnpj_recebedor': 'string[pyarrow]',
+        'chave_pix': 'string[pyarrow]',
+    })
+    # Ordenação estável: comprovantes do mesmo dia mantêm a ordem do banco
+    return df.sort_values('data_dt', ascending=False, kind='stable')
+
+@st.cache_resource(ttl="10m", max_entries=256)
+def build_indexes(_db_client: Client, term: str = ""):
+    """Indexa os comprovantes do termo por CNPJ, retornando os comprovantes e o nome de cada recebedor."""
+    df = build_df(_db_client, term)
+    # CNPJ nulo vira "" para que esses comprovantes não sejam descartados pelo groupby
+    groups = df.groupby(df['cnpj_recebedor'].fillna(""), sort=False)
+    mapping = {cnpj: group for cnpj, group in groups}
+    cnpj_to_name = groups['nome_recebedor'].first().to_dict()
+    return mapping, cnpj_to_name
+
+@st.cache_resource(ttl="10m", max_entries=256)
+def build_display_options(_db_client: Client, term: str = ""):
+    """Monta as opções do seletor de recebedores ("CNPJ - Nome") e a lista de rótulos, na ordem de exibição."""
+    _, cnpj_to_name = build_indexes(_db_client, term)
+    display_options = {f"{cnpj or 'N/A'} - {name}": cnpj for cnpj, name in cnpj_to_name.items()}
+    return display_options, list(display_options.keys())
+
+# --- Download e União dos PDFs ---
+# Sessão compartilhada: mantém conexões keep-alive com o Storage entre downloads e threads
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+
+class PdfDownloadError(Exception):
+    """Indica que parte dos PDFs não pôde ser baixada, impedindo a geração do PDF único."""
+
+    def __init__(self, failed: int, total: int):
+        super().__init__(
+            f"Não foi possível baixar {failed} de {total} comprovantes. Tente novamente para gerar o PDF único."
+        )
+        self.failed = failed
+        self.total = total
+
+def _download_pdf(pdf_url: str):
+    """Baixa um PDF em streaming para um arquivo temporário, ou retorna None se o download falhar."""
+    # Fica em memória até 4 MB e passa para o disco acima disso, limitando o pico de RAM
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    try:
+        with _http.get(pdf_url, stream=True, timeout=10) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                pdf_file.write(chunk)
+    except requests.exceptions.RequestException:
+        pdf_file.close()
+        return None # A falha é contabilizada por merge_pdfs_from_urls
+    pdf_file.seek(0)
+    return pdf_file
+
+def pdf_urls_digest(pdf_urls: tuple[str, ...]) -> str:
+    """Gera um resumo curto e determinístico das URLs, usado como chave do cache da união."""
+    return hashlib.blake2b("\n".join(pdf_urls).encode(), digest_size=16).hexdigest()
+
+# Cache só em memória, limitado por ttl e max_entries: os PDFs unidos (dados financeiros) não
+# são gravados no disco local; a persistência entre reinícios fica a cargo do Storage.
+# Apenas o resumo entra na chave do cache: as URLs (com "_") não são hasheadas pelo Streamlit.
+# Se algum download falhar, levanta PdfDownloadError: exceções não são cacheadas, então um
+# PDF incompleto nunca fica salvo e a próxima tentativa baixa tudo de novo.
+@st.cache_data(ttl="24h", max_entries=64, show_spinner="Unindo PDFs…")
+def merge_pdfs_from_urls(urls_digest: str, _pdf_urls: tuple[str, ...]):
+    """Busca em paralelo, une e retorna os dados de um PDF combinado."""
+    # Os downloads rodam em paralelo; map preserva a ordem original dos comprovantes
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        pdf_files = list(executor.map(_download_pdf, _pdf_urls))
+
+    failed = sum(pdf_file is None for pdf_file in pdf_files)
+    if failed:
+        for pdf_file in pdf_files:
+            if pdf_file is not None:
+                pdf_file.close()
+        raise PdfDownloadError(failed, len(pdf_files))
+
+    # A união fica na thread principal; os PDFs de origem permanecem abertos até o save,
+    # pois o qpdf só copia o conteúdo das páginas no momento da escrita
+    with contextlib.ExitStack() as stack:
+        merged_pdf = pikepdf.Pdf.new()
+        for pdf_file in pdf_files:
+            stack.enter_context(pdf_file)
+            source_pdf = stack.enter_context(pikepdf.Pdf.open(pdf_file))
+            merged_pdf.pages.extend(source_pdf.pages)
+
+        merged_pdf_buffer = io.BytesIO()
+        merged_pdf.save(merged_pdf_buffer)
+    return merged_pdf_buffer.getvalue()
+
+# --- PDFs Unidos no Storage ---
+MERGED_PDF_BUCKET = "merged-comprovantes"
+SIGNED_URL_TTL = 3600  # Validade, em segundos, das URLs assinadas
+
+# Erros de Storage/PostgREST (ex.: chave sem permissão) que a interface trata voltando a unir o PDF localmente
+STORAGE_ERRORS = (PostgrestAPIError, StorageException, httpx.HTTPError)
+
+# Só o caminho no Storage é cacheado (consulta à tabela e upload); a URL assinada é gerada a
+# cada renderização, para que todo link exibido tenha a validade completa de SIGNED_URL_TTL.
+# Erros não são cacheados: se algum download falhar, PdfDownloadError sobe antes do upload,
+# então um PDF incompleto nunca é enviado ao Storage nem registrado em merged_comprovantes.
+@st.cache_data(ttl="1h", max_entries=256, show_spinner="Preparando PDF único…")
+def get_merged_pdf_path(_db_client: Client, cnpj: str, urls_digest: str, _pdf_urls: tuple[str, ...]):
+    """Retorna o caminho do PDF unido no Storage, gerando e enviando o arquivo na primeira vez."""
+    response = _db_client.table('merged_comprovantes').select('storage_path').eq(
+        'cnpj', cnpj
+    ).eq('urls_digest', urls_digest).limit(1).execute()
+
+    if response.data:
+        return response.data[0]['storage_path']
+
+    storage_path = f"{cnpj or 'sem-cnpj'}/{urls_digest}.pdf"
+    merged_pdf_data = merge_pdfs_from_urls(urls_digest, _pdf_urls)
+    _db_client.storage.from_(MERGED_PDF_BUCKET).upload(
+        storage_path, merged_pdf_data, {"content-type": "application/pdf", "upsert": "true"}
+    )
+    _db_client.table('merged_comprovantes').upsert(
+        {"cnpj": cnpj, "urls_digest": urls_digest, "storage_path": storage_path}
+    ).execute()
+    return storage_path
+
+def get_merged_pdf_url(db_client: Client, cnpj: str, urls_digest: str, pdf_urls: tuple[str, ...]):
+    """Retorna uma URL assinada, recém-gerada, do PDF unido no Storage."""
+    storage_path = get_merged_pdf_path(db_client, cnpj, urls_digest, pdf_urls)
+    signed = db_client.storage.from_(MERGED_PDF_BUCKET).create_signed_url(
+        storage_path, SIGNED_URL_TTL, {"download": f"comprovantes_{cnpj or 'sem-cnpj'}.pdf"}
+    )
+    return signed["signedURL"]
 
 # --- Interface Principal ---
-if not supabase:
-    st.stop()
+RESULTS_PAGE_SIZE = 50
 
-all_receipts = fetch_data_from_supabase(supabase)
+def render_merged_pdf_button(cnpj: str, pdf_urls: tuple[str, ...], label: str):
+    """Exibe o botão do PDF único: link assinado do Storage ou, se indisponível, download local."""
+    urls_digest = pdf_urls_digest(pdf_urls)
+    merged_pdf_url = None
 
-if not all_receipts:
-    st.warning("Nenhum comprovante encontrado no banco de dados. Use o script 'upload_to_supabase.py' para enviar dados.")
-else:
-    search_term = st.text_input("Buscar por CNPJ/CPF, Nome ou Chave PIX:")
+    # Após uma falha do Storage, a sessão não tenta de novo a cada rerun do fragmento
+    if not st.session_state.get("merged_storage_unavailable"):
+        try:
+            merged_pdf_url = get_merged_pdf_url(supabase, cnpj, urls_digest, pdf_urls)
+        except PdfDownloadError as e:
+            st.warning(str(e))
+            return
+        except STORAGE_ERRORS as e:
+            st.session_state["merged_storage_unavailable"] = True
+            st.warning(f"PDF único indisponível no Storage ({e}); ele será gerado localmente nesta sessão.")
 
-    if search_term:
-        search_term_lower = search_term.lower()
-        filtered_receipts = [
-            r for r in all_receipts if
-            (r.get('nome_recebedor') and search_term_lower in r['nome_recebedor'].lower()) or
-            (r.get('cnpj_recebedor') and search_term_lower in r['cnpj_recebedor'].lower()) or
-            (r.get('chave_pix') and search_term_lower in r['chave_pix'].lower())
-        ]
-    else:
-        filtered_receipts = all_receipts
+    if merged_pdf_url:
+        st.link_button(label, merged_pdf_url)
+        return
 
-    if not filtered_receipts:
-        st.info("Nenhum comprovante encontrado para o termo buscado.")
-    else:
-        mapping = defaultdict(lambda: defaultdict(list))
-        cnpj_to_name = {}
-        for receipt in filtered_receipts:
-            cnpj = receipt['cnpj_recebedor']
-            date_str = datetime.strptime(receipt['data_transferencia'], '%Y-%m-%d').strftime('%d/%m/%Y')
-            
-            if cnpj not in cnpj_to_name:
-                cnpj_to_name[cnpj] = receipt['nome_recebedor']
-            
-            mapping[cnpj][date_str].append(receipt)
+    try:
+        merged_pdf_data = merge_pdfs_from_urls(urls_digest, pdf_urls)
+    except PdfDownloadError as e:
+        # Nunca oferece um "PDF único" com comprovantes faltando
+        st.warning(str(e))
+        return
 
-        display_options = {f"{cnpj} - {name}": cnpj for cnpj, name in cnpj_to_name.items()}
-        
-        if not display_options:
-            st.info("Nenhum recebedor corresponde à busca.")
+    st.download_button(
+        label=label,
+        data=merged_pdf_data,
+        file_name=f"comprovantes_{cnpj or 'sem-cnpj'}.pdf",
+        mime="application/pdf"
+    )
+
+@st.fragment
+def render_results(search_term: str):
+    """Renderiza os resultados da busca; trocar o recebedor reexecuta apenas este fragmento."""
+    try:
+        df = build_df(supabase, search_term)
+    except SupabaseFetchError as e:
+        st.error(str(e))
+        return
+
+    if not search_term and df.empty:
+        st.warning("Nenhum comprovante encontrado no banco de dados. Use o script 'upload_to_supabase.py' para enviar dados.")
+    else:
+        if df.empty:
+            st.info("Nenhum comprovante encontrado para o termo buscado.")
         else:
-            selected_display = st.selectbox("Selecione o Recebedor", list(display_options.keys()))
+            mapping, _ = build_indexes(supabase, search_term)
+            display_options, option_labels = build_display_options(supabase, search_term)
+        
+            if not display_options:
+                st.info("Nenhum recebedor corresponde à busca.")
+            else:
+                selected_display = st.selectbox("Selecione o Recebedor", option_labels)
 
-            if selected_display:
-                selected_cnpj = display_options[selected_display]
-                
-                all_date_receipts = mapping.get(selected_cnpj, {})
-                all_receipts_for_cnpj = []
-                sorted_dates = sorted(all_date_receipts.keys(), key=lambda d: datetime.strptime(d, '%d/%m/%Y'), reverse=True)
+                if selected_display:
+                    selected_cnpj = display_options[selected_display]
                 
-                for date_key in sorted_dates:
-                    all_receipts_for_cnpj.extend(all_date_receipts[date_key])
-
-                if all_receipts_for_cnpj:
-                    # --- Botão para baixar todos os PDFs ---
-                    if len(all_receipts_for_cnpj) > 1:
-                        
-                        @st.cache_data
-                        def merge_pdfs_from_urls(_receipts_tuple):
-                            """Busca, une e retorna os dados de um PDF combinado."""
-                            receipts = [dict(item) for item in _receipts_tuple]
-                            pdf_writer = PdfWriter()
-                            
-                            for r in receipts:
-                                pdf_url = r.get('pdf_url')
-                                if pdf_url:
-                                    try:
-                                        response = requests.get(pdf_url, timeout=10)
-                                        response.raise_for_status()
-                                        pdf_reader = PdfReader(io.BytesIO(response.content))
-                                        for page in pdf_reader.pages:
-                                            pdf_writer.add_page(page)
-                                    except requests.exceptions.RequestException:
-                                        pass # Ignora erros de download para não quebrar a UI
-                            
-                            merged_pdf_buffer = io.BytesIO()
-                            pdf_writer.write(merged_pdf_buffer)
-                            return merged_pdf_buffer.getvalue()
-
-                        # Transforma a lista de dicionários em um tipo hasheável para o cache
-                        hashable_receipts = tuple(frozenset(d.items()) for d in all_receipts_for_cnpj)
-                        merged_pdf_data = merge_pdfs_from_urls(hashable_receipts)
-
-                        st.download_button(
-                            label=f"📥 Baixar todos os {len(all_receipts_for_cnpj)} comprovantes (PDF único)",
-                            data=merged_pdf_data,
-                            file_name=f"comprovantes_{selected_cnpj}.pdf",
-                            mime="application/pdf"
+                    df_for_cnpj = mapping[selected_cnpj]
+
+                    if not df_for_cnpj.empty:
+                        # --- Botão para baixar todos os PDFs ---
+                        # A chave do cache são apenas as URLs, únicos dados usados na união
+                        pdf_urls = tuple(url for url in df_for_cnpj['pdf_url'].dropna() if url)
+                        if len(pdf_urls) > 1:
+                            # O rótulo conta os PDFs que de fato entram no arquivo único
+                            render_merged_pdf_button(
+                                selected_cnpj,
+                                pdf_urls,
+                                f"📥 Baixar todos os {len(pdf_urls)} comprovantes (PDF único)",
+                            )
+
+                        st.write(f"### {len(df_for_cnpj)} Comprovante(s) encontrado(s):")
+
+                        # Paginação: exibe no máximo RESULTS_PAGE_SIZE comprovantes por vez
+                        total_pages = math.ceil(len(df_for_cnpj) / RESULTS_PAGE_SIZE)
+                        page = 1
+                        if total_pages > 1:
+                            page = st.number_input("Página", min_value=1, max_value=total_pages, key=f"page_{selected_cnpj}")
+                        start = (page - 1) * RESULTS_PAGE_SIZE
+                        page_df = df_for_cnpj.iloc[start:start + RESULTS_PAGE_SIZE]
+
+                        # Uma única tabela em vez de colunas e textos por comprovante
+                        st.dataframe(
+                            page_df[['nome_recebedor', 'cnpj_recebedor', 'valor_fmt', 'data_fmt', 'pdf_url']],
+                            column_config={
+                                'nome_recebedor': "Recebedor",
+                                'cnpj_recebedor': "CNPJ/CPF",
+                                'valor_fmt': "Valor",
+                                'data_fmt': "Data",
+                                'pdf_url': st.column_config.LinkColumn("PDF", display_text="Baixar PDF"),
+                            },
+                            hide_index=True,
                         )
+                        if total_pages > 1:
+                            st.caption(f"Exibindo {start + 1}–{start + len(page_df)} de {len(df_for_cnpj)} comprovantes")
+
+                        total_value = float(df_for_cnpj['valor'].sum())
+                        st.metric("💰 Total para este recebedor", format_brl(total_value))
+
+
+if not supabase:
+    st.stop()
+
+# Descarta os dados em cache para buscar novamente no Supabase
+if st.button("🔄 Atualizar dados"):
+    for cached in (fetch_data_from_supabase, fetch_matching, build_df, build_indexes, build_display_options):
+        cached.clear()
+
+# Em um formulário, a busca só roda ao enviar (Enter ou botão), e não a cada tecla digitada
+with st.form("search"):
+    search_term = st.text_input("Buscar por CNPJ/CPF, Nome ou Chave PIX:")
+    st.form_submit_button("Buscar")
 
-                    st.write(f"### {len(all_receipts_for_cnpj)} Comprovante(s) encontrado(s):")
-                    st.divider()
-
-                    total_value = 0
-                    
-                    for i, item in enumerate(all_receipts_for_cnpj):
-                        total_value += item.get('valor', 0)
-                        
-                        valor_formatado = f"R$ {item.get('valor', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                        data_formatada = datetime.strptime(item['data_transferencia'], '%Y-%m-%d').strftime('%d/%m/%Y')
-
-                        col1, col2 = st.columns([4, 1])
-                        
-                        with col1:
-                            st.text(f"Recebedor: {item.get('nome_recebedor', 'N/A')}")
-                            st.text(f"CNPJ/CPF: {item.get('cnpj_recebedor', 'N/A')}")
-                            st.text(f"Valor: {valor_formatado}")
-                            st.text(f"Data: {data_formatada}")
-
-                        with col2:
-                            pdf_url = item.get('pdf_url')
-                            if pdf_url:
-                                st.markdown(f'''<a href="{pdf_url}" target="_blank" style="display: inline-block; padding: 8px 16px; background-color: #FF4B4B; color: white; text-align: center; text-decoration: none; border-radius: 4px;">Baixar PDF</a>''', unsafe_allow_html=True)
-                            else:
-                                st.warning("PDF não disponível")
-                        
-                        if i < len(all_receipts_for_cnpj) - 1:
-                            st.divider()
-
-                    st.metric("💰 Total para este recebedor", f"R$ {total_value:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
+render_results(search_term)
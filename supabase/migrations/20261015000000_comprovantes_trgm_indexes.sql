@@ -0,0 +1,11 @@
+-- Índices trigram para que os filtros `ilike '%termo%'` da busca usem index scan
+create extension if not exists pg_trgm with schema extensions;
+
+create index if not exists comprovantes_nome_recebedor_trgm_idx
+    on public.comprovantes using gin (nome_recebedor extensions.gin_trgm_ops);
+
+create index if not exists comprovantes_cnpj_recebedor_trgm_idx
+    on public.comprovantes using gin (cnpj_recebedor extensions.gin_trgm_ops);
+
+create index if not exists comprovantes_chave_pix_trgm_idx
+    on public.comprovantes using gin (chave_pix extensions.gin_trgm_ops);
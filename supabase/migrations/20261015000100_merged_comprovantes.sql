@@ -0,0 +1,19 @@
+-- Registro dos PDFs unidos já enviados ao Storage, por recebedor e conjunto de comprovantes.
+-- Tabela e bucket são acessados apenas com a chave service_role (SUPABASE_KEY do app), que
+-- ignora o RLS; sem políticas, as chaves anon/authenticated não leem nem gravam nada aqui.
+create table if not exists public.merged_comprovantes (
+    cnpj text not null,
+    urls_digest text not null,
+    storage_path text not null,
+    created_at timestamptz not null default now(),
+    primary key (cnpj, urls_digest)
+);
+
+alter table public.merged_comprovantes enable row level security;
+revoke all on table public.merged_comprovantes from anon, authenticated;
+
+-- Bucket privado: os PDFs unidos são baixados apenas por URLs assinadas. Não há políticas em
+-- storage.objects para este bucket, então upload e assinatura exigem a chave service_role.
+insert into storage.buckets (id, name, public)
+values ('merged-comprovantes', 'merged-comprovantes', false)
+on conflict (id) do nothing;